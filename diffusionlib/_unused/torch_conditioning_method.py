@@ -3,7 +3,6 @@
 from abc import ABC, abstractmethod
 from enum import StrEnum
 
-import functorch
 import torch
 
 __CONDITIONING_METHOD__ = {}
@@ -33,31 +32,62 @@ def get_conditioning_method(name: ConditioningMethod, operator, noiser, **kwargs
     return __CONDITIONING_METHOD__[name](operator=operator, noiser=noiser, **kwargs)
 
 
+def _cache_key(x, kwargs):
+    # the cached kwargs are held (and compared by identity) so that e.g. a new mask of the same
+    # shape invalidates the cache
+    return x.shape, x.device, x.dtype, dict(kwargs)
+
+
+def _cache_hit(key, x, kwargs):
+    if key is None:
+        return False
+    shape, device, dtype, cached_kwargs = key
+    return (
+        shape == x.shape
+        and device == x.device
+        and dtype == x.dtype
+        and cached_kwargs.keys() == kwargs.keys()
+        and all(cached_kwargs[k] is v for k, v in kwargs.items())
+    )
+
+
 class ConditioningMethod_(ABC):
     def __init__(self, operator, noiser, **kwargs):
         self.operator = operator
         self.noiser = noiser
+        self._zero = None
+
+    def zero(self, x):
+        # reuse a zero norm on the device of x, rather than allocating one on the host each step
+        if self._zero is None or self._zero.device != x.device:
+            self._zero = torch.zeros(1, device=x.device)
+        return self._zero
 
     def project(self, data, noisy_measurement, **kwargs):
         return self.operator.project(data=data, measurement=noisy_measurement, **kwargs)
 
     def grad_and_value(self, x_prev, x_0_hat, measurement, **kwargs):
         if self.noiser.__name__ == "gaussian":
-            difference = measurement - self.operator.forward(x_0_hat, **kwargs)
-            norm = torch.linalg.norm(difference)
-            norm_grad = torch.autograd.grad(outputs=norm, inputs=x_prev)[0]
+            # seed the vjp with d||y - Ax||/dAx directly, rather than backpropagating through
+            # the norm itself
+            h_x = self.operator.forward(x_0_hat, **kwargs)
+            difference = (measurement - h_x).detach()
+            norm = difference.pow(2).sum().sqrt()
+            seed = -difference / norm.clamp_min(torch.finfo(norm.dtype).eps)
+            norm_grad = torch.autograd.grad(outputs=h_x, inputs=x_prev, grad_outputs=seed)[0]
 
         elif self.noiser.__name__ == "poisson":
             Ax = self.operator.forward(x_0_hat, **kwargs)
             difference = measurement - Ax
-            norm = torch.linalg.norm(difference) / measurement.abs()
+            norm = difference.pow(2).sum().sqrt() / measurement.abs()
             norm = norm.mean()
             norm_grad = torch.autograd.grad(outputs=norm, inputs=x_prev)[0]
 
         else:
             raise NotImplementedError
 
-        return norm_grad, norm
+        # norm is a diagnostic only; return it off the graph for every noiser
+        return norm_grad, norm.detach()
 
     @abstractmethod
     def conditioning(self, x_t, measurement, noisy_measurement=None, **kwargs):
@@ -68,14 +98,14 @@ class ConditioningMethod_(ABC):
 class Identity(ConditioningMethod_):
     # just pass the input without conditioning
     def conditioning(self, x_t, **kwargs):
-        return x_t, torch.Tensor([0])
+        return x_t, self.zero(x_t)
 
 
 @register_conditioning_method(name=ConditioningMethod.PROJECTION)
 class Projection(ConditioningMethod_):
     def conditioning(self, x_t, noisy_measurement, **kwargs):
         x_t = self.project(data=x_t, noisy_measurement=noisy_measurement, **kwargs)
-        return x_t, torch.Tensor([0])
+        return x_t, self.zero(x_t)
 
 
 @register_conditioning_method(name=ConditioningMethod.MANIFOLD_CONSTRAINT_GRADIENT)
@@ -89,7 +119,7 @@ class ManifoldConstraintGradient(ConditioningMethod_):
         norm_grad, norm = self.grad_and_value(
             x_prev=x_prev, x_0_hat=x_0_hat, measurement=measurement, **kwargs
         )
-        x_t -= norm_grad * self.scale
+        x_t.sub_(norm_grad, alpha=self.scale)
 
         # projection
         x_t = self.project(data=x_t, noisy_measurement=noisy_measurement, **kwargs)
@@ -106,7 +136,7 @@ class PosteriorSampling(ConditioningMethod_):
         norm_grad, norm = self.grad_and_value(
             x_prev=x_prev, x_0_hat=x_0_hat, measurement=measurement, **kwargs
         )
-        x_t -= norm_grad * self.scale
+        x_t.sub_(norm_grad, alpha=self.scale)
         return x_t, norm
 
 
@@ -116,17 +146,43 @@ class PosteriorSamplingPlus(ConditioningMethod_):
         super().__init__(operator, noiser)
         self.num_sampling = kwargs.get("num_sampling", 5)
         self.scale = kwargs.get("scale", 1.0)
+        self.seed = kwargs.get("seed", None)
+        self._noise_buf = None
+        self._generator = None
+
+    def get_noise_buf(self, x_0_hat):
+        shape = (self.num_sampling, *x_0_hat.shape)
+        # without an explicit seed, sample from the global generator so torch.manual_seed still
+        # makes runs reproducible
+        if self.seed is not None and (
+            self._generator is None or self._generator.device != x_0_hat.device
+        ):
+            self._generator = torch.Generator(device=x_0_hat.device)
+            self._generator.manual_seed(self.seed)
+        if (
+            self._noise_buf is None
+            or self._noise_buf.shape != shape
+            or self._noise_buf.device != x_0_hat.device
+            or self._noise_buf.dtype != x_0_hat.dtype
+        ):
+            self._noise_buf = torch.empty(shape, device=x_0_hat.device, dtype=x_0_hat.dtype)
+        return self._noise_buf
 
     def conditioning(self, x_prev, x_t, x_0_hat, measurement, **kwargs):
-        norm = 0
-        for _ in range(self.num_sampling):
-            # TODO: use noiser?
-            x_0_hat_noise = x_0_hat + 0.05 * torch.rand_like(x_0_hat)
-            difference = measurement - self.operator.forward(x_0_hat_noise)
-            norm += torch.linalg.norm(difference) / self.num_sampling
+        # draw all num_sampling perturbations at once, in place into a reused buffer, and push
+        # them through the operator as a single batch
+        # NOTE: num_sampling is folded into the batch dimension, so operator.forward must be
+        # batch-agnostic; any batched operator state (e.g. a mask) must have a leading dimension
+        # of 1 so that it broadcasts against the (num_sampling * B, ...) input
+        # TODO: use noiser?
+        noise = self.get_noise_buf(x_0_hat).normal_(mean=0.0, std=0.05, generator=self._generator)
+        x_0_hat_noise = (x_0_hat.unsqueeze(0) + noise).flatten(0, 1)
+        h_x = self.operator.forward(x_0_hat_noise).reshape(self.num_sampling, *measurement.shape)
+        difference = measurement.unsqueeze(0) - h_x
+        norm = difference.flatten(1).pow(2).sum(-1).sqrt().mean()
 
         norm_grad = torch.autograd.grad(outputs=norm, inputs=x_prev)[0]
-        x_t -= norm_grad * self.scale
+        x_t.sub_(norm_grad, alpha=self.scale)
         return x_t, norm
 
 
@@ -156,12 +212,14 @@ class PsuedoInverseGuided(ConditioningMethod_):
             return self.operator.forward(x_0, **kwargs), (x_0, eps)
 
         if self.noiser.__name__ == "gaussian":
-            h_x_0, vjp_estimate_h_x_0, (x_0, eps) = functorch.vjp(estimate_h_x_0, x_t, has_aux=True)
+            h_x_0, vjp_estimate_h_x_0, (x_0, eps) = torch.func.vjp(
+                estimate_h_x_0, x_t, has_aux=True
+            )
             r = v * self.scale / (v + self.scale)
             C_yy = 1.0 + noise_std**2 / r
             difference = measurement - h_x_0
-            norm = torch.linalg.norm(difference)
-            ls = vjp_estimate_h_x_0(difference / C_yy)[0]
+            norm = difference.detach().square().sum().sqrt()
+            ls = vjp_estimate_h_x_0(difference.div_(C_yy))[0]
             # ls = 0   # setting to zero shows that the rest of the code works for unconditional sampling
         else:
             raise NotImplementedError
@@ -189,12 +247,12 @@ class AltPsuedoInverseGuided(ConditioningMethod_):
             return self.operator.forward(x_0, **kwargs), x_0
 
         if self.noiser.__name__ == "gaussian":
-            h_x_0, vjp_estimate_h_x_0, x_0 = functorch.vjp(estimate_h_x_0, x_t, has_aux=True)
+            h_x_0, vjp_estimate_h_x_0, x_0 = torch.func.vjp(estimate_h_x_0, x_t, has_aux=True)
             r = v * self.scale / (v + self.scale)
             C_yy = 1.0 + noise_std**2 / r
             difference = measurement - h_x_0
-            norm = torch.linalg.norm(difference)
-            ls = vjp_estimate_h_x_0(difference / C_yy)[0]
+            norm = difference.detach().square().sum().sqrt()
+            ls = vjp_estimate_h_x_0(difference.div_(C_yy))[0]
             # ls = 0   # setting to zero shows that the rest of the code works for unconditional sampling
             x_0 = x_0 + ls
         else:
@@ -209,6 +267,38 @@ class TweedieMomentProjection(ConditioningMethod_):
         super().__init__(operator, noiser)
         self.num_sampling = kwargs.get("num_sampling", 5)
         # self.scale = kwargs.get('scale', 1.0)
+        # H(1) is cached per input shape/device/dtype and operator kwargs (e.g. mask)
+        self._ones_fwd = None
+        self._ones_fwd_key = None
+        # NOTE: identity_jacobian_cyy=True replaces the denoiser Jacobian J = dx_0/dx_t in C_yy by
+        # I, so that H H^T H(1) only depends on the operator and is computed once. This is a crude
+        # approximation: J is roughly I / sqrt(alpha_bar), far from I at high noise levels
+        self.identity_jacobian_cyy = kwargs.get("identity_jacobian_cyy", False)
+        self._HHt_ones_fwd = None
+        self._HHt_ones_fwd_key = None
+
+    def reset(self):
+        self._ones_fwd = None
+        self._ones_fwd_key = None
+        self._HHt_ones_fwd = None
+        self._HHt_ones_fwd_key = None
+
+    def ones_forward(self, x_0, **kwargs):
+        if not _cache_hit(self._ones_fwd_key, x_0, kwargs):
+            self._ones_fwd = self.operator.forward(torch.ones_like(x_0), **kwargs).detach()
+            self._ones_fwd_key = _cache_key(x_0, kwargs)
+        return self._ones_fwd
+
+    def hht_ones_forward(self, x_0, **kwargs):
+        if not _cache_hit(self._HHt_ones_fwd_key, x_0, kwargs):
+            _, vjp_forward = torch.func.vjp(
+                lambda x: self.operator.forward(x, **kwargs), torch.zeros_like(x_0)
+            )
+            self._HHt_ones_fwd = self.operator.forward(
+                vjp_forward(self.ones_forward(x_0, **kwargs))[0], **kwargs
+            ).detach()
+            self._HHt_ones_fwd_key = _cache_key(x_0, kwargs)
+        return self._HHt_ones_fwd
 
     def conditioning(self, x_t, measurement, estimate_x_0, r, v, noise_std, **kwargs):
         def estimate_h_x_0(x_t):
@@ -234,16 +324,16 @@ class TweedieMomentProjection(ConditioningMethod_):
             # print(h_x_0.shape)
             # print(x_0.shape)
             # y = self.operator.forward(torch.ones_like(x_0), **kwargs)
-            C_yy = (
-                self.operator.forward(
-                    vjp_estimate_h_x_0(self.operator.forward(torch.ones_like(x_0), **kwargs))[0],
-                    **kwargs,
+            if self.identity_jacobian_cyy:
+                h_grad_h_ones = self.hht_ones_forward(x_0, **kwargs)
+            else:
+                h_grad_h_ones = self.operator.forward(
+                    vjp_estimate_h_x_0(self.ones_forward(x_0, **kwargs))[0], **kwargs
                 )
-                + noise_std**2 / r
-            )
+            C_yy = h_grad_h_ones + noise_std**2 / r
             difference = measurement - h_x_0
-            norm = torch.linalg.norm(difference)
-            ls = vjp_estimate_h_x_0(difference / C_yy)[0]
+            norm = difference.detach().square().sum().sqrt()
+            ls = vjp_estimate_h_x_0(difference.div_(C_yy))[0]
 
             # x_0 = x_0 + ls  # TODO: commenting it out shows that rest of the code works okay
         else: